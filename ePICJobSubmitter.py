@@ -3,97 +3,412 @@
 # February 20th 2026 - Upgraded for XRDFS input
 
 import os
+import re
+import sys
+import math
+import time
+import json
+import hashlib
+import shutil
+import tempfile
 import subprocess
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from XRootD import client
+    from XRootD.client.flags import DirListFlags
+except ImportError:
+    client = None
+
+XRDFS_SERVER = "dtn-eic.jlab.org"
+WRITE_BUFFER = 1 << 20
+CACHE_DIR = os.path.expanduser("~/.cache/epic_submitter")
+PROBE_POLL_INTERVAL = 5  # seconds between condor_history/condor_q polls for probe wall times
+LOG_SHARD_SIZE = 1000  # jobs per logs/NNNN directory, i.e. at most 3000 .out/.err/.log files
+
+# "xrdfs ls -l" line: "<flags> <date> <time> [...] <size> <path>". The size is the
+# field just before the absolute path, and the path (spaces allowed) runs to the end.
+# Both patterns are run once over the whole output; [^\n] and [ \t] keep matches on one line
+XRDFS_LS_ROOT = re.compile(r"^(?:[^\n]*?[ \t])?(\d+)[ \t]+(/[^\n]*\.root)[ \t]*$", re.M)
+XRDFS_ANY_ROOT = re.compile(r"^[^\n]*\.root[ \t]*$", re.M)
+
+def atomic_write(path, data):
+    """Publish data at path in one step, so Condor never sees a partially written file."""
+    directory = os.path.dirname(path) or "."
+    payload = data.encode()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    # Preferred: write into an anonymous O_TMPFILE inode, then give it a name
+    try:
+        fd = os.open(directory, os.O_TMPFILE | os.O_WRONLY, 0o644)
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        try:
+            with os.fdopen(fd, "wb", buffering=WRITE_BUFFER) as f:
+                f.write(payload)
+                f.flush()
+                os.link(f"/proc/self/fd/{fd}", tmp_path)
+            os.replace(tmp_path, path)
+            return
+        except OSError:
+            pass
+
+    # Fallback (e.g. NFS, non-Linux): named temporary file renamed into place
+    with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False, buffering=WRITE_BUFFER) as f:
+        f.write(payload)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+
+def list_xrdfs_dir(path):
+    """Recursively list one XRDFS directory and return the non-empty ROOT file paths in it."""
+    if client is None:
+        # No Python bindings available, fall back to the xrdfs command line tool
+        result = subprocess.run(
+            ["xrdfs", XRDFS_SERVER, "ls", "-R", "-l", path],
+            check=True, stdout=subprocess.PIPE, text=True
+        )
+        entries = XRDFS_LS_ROOT.findall(result.stdout)
+
+        # Never drop a ROOT file silently because its listing line looks unexpected
+        unparsed = len(XRDFS_ANY_ROOT.findall(result.stdout)) - len(entries)
+        if unparsed:
+            print(f"Warning: could not parse {unparsed} .root entries listed under {path}")
+        return [name for size, name in entries if int(size) > 0]
+
+    fs = client.FileSystem(f"root://{XRDFS_SERVER}")
+    status, listing = fs.dirlist(path, DirListFlags.STAT | DirListFlags.RECURSIVE)
+    if not status.ok:
+        raise OSError(f"xrootd dirlist of {path} failed: {status.message}")
+    return [os.path.join(listing.parent, entry.name) for entry in listing
+            if entry.name.endswith(".root") and entry.statinfo.size > 0]
+
+def xrdfs_mtime(path):
+    """Return the modification time of an XRDFS path, as reported by the server."""
+    if client is None:
+        result = subprocess.run(
+            ["xrdfs", XRDFS_SERVER, "stat", path],
+            check=True, stdout=subprocess.PIPE, text=True
+        )
+        for line in result.stdout.splitlines():
+            if line.startswith("MTime:"):
+                return line.split(":", 1)[1].strip()
+        return None
+
+    fs = client.FileSystem(f"root://{XRDFS_SERVER}")
+    status, statinfo = fs.stat(path)
+    if not status.ok:
+        raise OSError(f"xrootd stat of {path} failed: {status.message}")
+    return statinfo.modtime
+
+def cached_list_xrdfs_dir(path):
+    """list_xrdfs_dir() with a local cache that is reused while the top-level directory mtime is unchanged.
+
+    Only used with --use-cache: the mtime does not change when files are added in
+    subdirectories or when a file's size changes, so a cached listing can miss inputs.
+    """
+    key = hashlib.sha1(f"{XRDFS_SERVER}:{path}".encode()).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.json")
+    mtime = xrdfs_mtime(path)
+
+    if mtime is not None:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached["mtime"] == mtime:
+                return cached["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    files = list_xrdfs_dir(path)
+
+    # A missing or read-only cache directory must not break submission
+    if mtime is not None:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            atomic_write(cache_path, json.dumps({"path": path, "mtime": mtime, "files": files}))
+        except OSError:
+            pass
+    return files
+
+def log_shard_dir(job_folder, proc_id):
+    """Directory holding the .out/.err/.log files of the job with the given ProcId."""
+    return os.path.join(job_folder, "logs", f"{proc_id // LOG_SHARD_SIZE:04d}")
+
+def write_job_files(args, tag, files, n_requested, output_dir, job_folder, late_materialize=True):
+    """Write the file list and items file (plus the submit file with --save-sub); return the submit description."""
+    total_files = len(files)
+
+    # XRDFS file list for Condor jobs
+    input_list_file = os.path.join(job_folder, f"{tag}.list")
+
+    # 3. Partition files and prepare the item list for Condor
+    # Each job reads lines [Start, End) of the shared list; the list path is a
+    # constant of the submit file, so each item row only carries the slice
+    condor_items_file = os.path.join(job_folder, f"{tag}.items")
+    job_rows = []
+
+    # Partition boundaries are computed once; job i covers [bounds[i], bounds[i + 1])
+    bounds = [i * total_files // n_requested for i in range(n_requested + 1)]
+
+    # Rows are "Start, End, OutFile, Tag" with OutFile = "{Tag}.root" (remapped to the
+    # output dir when the job exits); the tag prefix is formatted once, not per row
+    prefix = f"{tag}_"
+    for filenumber, (start, end) in enumerate(zip(bounds, bounds[1:]), start=1):
+        job_tag = f"{prefix}{filenumber}"
+        job_rows.append(f"{start}, {end}, {job_tag}.root, {job_tag}")
+
+    # Condor logs are sharded by ProcId so no single directory grows past a few thousand entries
+    for proc_id in range(0, n_requested, LOG_SHARD_SIZE):
+        os.makedirs(log_shard_dir(job_folder, proc_id), exist_ok=True)
+
+    # 4. Build the Condor submit description; it is piped to condor_submit and
+    # only written to disk (on the shared output dir) when --save-sub is given
+    extra = f" {args.job_args}" if args.job_args else ""
+    submit_body = "\n".join([
+        "# HTCondor Submit File - V24 Compatible",
+        "Universe       = vanilla",
+        f"Executable     = {os.path.abspath(args.exec)}",
+        "getenv         = true",
+        "request_memory = 4G",
+        "notification   = Never",
+        "",
+        f"initialdir     = {job_folder}",
+        "should_transfer_files   = YES",
+        "when_to_transfer_output = ON_EXIT",
+        "",
+        f"InFile         = {os.path.basename(input_list_file)}",
+        "transfer_input_files    = $(InFile)",
+        "transfer_output_files   = $(OutFile)",
+        f"transfer_output_remaps  = \"$(OutFile) = {output_dir}/$(OutFile)\"",
+        f"Arguments      = $(InFile) $(Start) $(End) $(OutFile){extra}",
+        f"LogShard       = $(ProcId) / {LOG_SHARD_SIZE}",
+        f"Output         = {job_folder}/logs/$INT(LogShard,%04d)/$(Tag).out",
+        f"Error          = {job_folder}/logs/$INT(LogShard,%04d)/$(Tag).err",
+        f"Log            = {job_folder}/logs/$INT(LogShard,%04d)/$(Tag).log",
+        "",
+        "",
+    ])
+    if late_materialize:
+        submit_body += "\n".join([
+            "# Late materialization: the schedd creates jobs from the items file on demand",
+            f"max_idle        = {args.max_idle}",
+            f"max_materialize = {args.max_materialize}",
+            "",
+            "",
+        ])
+    submit_body += f"queue Start, End, OutFile, Tag from {condor_items_file}\n"
+
+    atomic_write(input_list_file, "\n".join(files))
+    atomic_write(condor_items_file, "\n".join(job_rows))
+    if args.save_sub:
+        master_condor_file = os.path.join(output_dir, f"submit_{tag}.sub")
+        print(f"Saving submit description to {master_condor_file}")
+        atomic_write(master_condor_file, submit_body)
+
+    return submit_body
+
+def submit_probe(args, files, output_dir, job_folder):
+    """Submit one single-file job per probe file; return the probe cluster id, or None if it cannot be read."""
+    # Probe jobs are not late-materialized, so condor_submit writes every job's
+    # user log right away and condor_wait never races the schedd
+    probe_body = write_job_files(args, f"{args.tag}_probe", files, len(files), output_dir, job_folder,
+                                 late_materialize=False)
+
+    print(f"Submitting {len(files)} probe jobs to Condor ...")
+    result = subprocess.run(["condor_submit"], input=probe_body, check=True, stdout=subprocess.PIPE, text=True)
+    print(result.stdout, end="")
+    match = re.search(r"submitted to cluster (\d+)", result.stdout)
+    return match.group(1) if match else None
+
+def probe_runtime(args, cluster, n_probes, job_folder):
+    """Wait for the probe jobs (at most --probe-timeout seconds) and return their mean wall time in seconds."""
+    tag = f"{args.tag}_probe"
+    deadline = time.monotonic() + args.probe_timeout
+
+    # Each probe job has its own user log; wait for all of them to finish
+    for proc_id in range(n_probes):
+        log_file = os.path.join(log_shard_dir(job_folder, proc_id), f"{tag}_{proc_id + 1}.log")
+        remaining = max(1, int(deadline - time.monotonic()))
+        subprocess.run(["condor_wait", "-wait", str(remaining), log_file, cluster], check=True)
+
+    # The schedd moves finished jobs into the history a little after the terminate
+    # event reaches the user log, so poll both the history and the completed jobs
+    # still in the queue until every probe has reported a wall time
+    runtimes = completed_wall_times(cluster)
+    while len(runtimes) < n_probes and time.monotonic() < deadline:
+        time.sleep(PROBE_POLL_INTERVAL)
+        runtimes = completed_wall_times(cluster)
+
+    if len(runtimes) < n_probes:
+        print(f"Only {len(runtimes)} of {n_probes} probe jobs reported a wall time")
+    return sum(runtimes.values()) / len(runtimes) if runtimes else None
+
+def completed_wall_times(cluster):
+    """Return {ProcId: RemoteWallClockTime} for the completed jobs of a cluster, in the history or still queued."""
+    runtimes = {}
+    for command in (["condor_history", cluster], ["condor_q", cluster, "-constraint", "JobStatus == 4"]):
+        result = subprocess.run(
+            command + ["-af", "ProcId", "RemoteWallClockTime"],
+            check=True, stdout=subprocess.PIPE, text=True
+        )
+        for line in result.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1] != "undefined":
+                runtimes[int(fields[0])] = float(fields[1])
+    return runtimes
 
 def main():
     parser = argparse.ArgumentParser(description="ePIC Condor Submitter (XRDFS input)")
     parser.add_argument("--tag", required=True, help="Job tag prefix, e.g. ep_test")
-    parser.add_argument("--exec", default="./job.sh", help="Shell script executable")
-    parser.add_argument("--input-dir", required=True, help="XRDFS directory path with input ROOT files")
+    parser.add_argument("--exec", default="./job.sh",
+                        help="Shell script executable, called as: EXEC LIST START END OUTFILE [JOB_ARGS]; "
+                             "it must process lines [START, END) of LIST, 0-based (sed -n \"$(($2 + 1)),${3}p\" \"$1\")")
+    parser.add_argument("--input-dir", required=True, nargs="+", help="XRDFS directory path(s) with input ROOT files")
     parser.add_argument("--output-dir", default="./results", help="Directory for output ROOT files")
+    parser.add_argument("--staging-dir", default=os.environ.get("TMPDIR", "/tmp"),
+                        help="Node-local directory under which a private job_<tag>_XXXXXX folder is created for the job list "
+                             "and Condor logs; it is the jobs' initialdir and must not be cleaned until all jobs have finished")
+    parser.add_argument("--use-cache", action="store_true",
+                        help="Reuse a cached listing while each input directory's mtime is unchanged; new files in "
+                             "subdirectories and files that were empty when cached are missed until the top-level directory changes")
     parser.add_argument("--njobs", type=int, default=1, help="Number of jobs to split into")
     parser.add_argument("--job-args", default="", help="Optional extra args")
+    parser.add_argument("--probe-files", type=int, default=0, help="Size --njobs from this many single-file probe jobs (0 disables)")
+    parser.add_argument("--target-efficiency", type=float, default=0.9, help="Target fraction of job wall time spent on payload when probing")
+    parser.add_argument("--probe-timeout", type=int, default=3600, help="Give up waiting for the probe jobs after this many seconds")
+    parser.add_argument("--dispatch-wait", type=float, default=60.0, help="Expected scheduling overhead per job in seconds when probing")
+    parser.add_argument("--save-sub", action="store_true", help="Also write submit_{tag}.sub to the output dir for debugging")
+    parser.add_argument("--dag", nargs="?", const="ePIC.dag", metavar="DAG_FILE",
+                        help="Append this submission as a node of DAG_FILE (default ePIC.dag) instead of submitting; run condor_submit_dag on it afterwards")
+    parser.add_argument("--max-idle", type=int, default=500, help="Maximum number of idle jobs materialized at once")
+    parser.add_argument("--max-materialize", type=int, default=1000, help="Maximum number of jobs materialized in the schedd at once")
     args = parser.parse_args()
 
-    # 1. List files from XRDFS
-    xrdfs_path = args.input_dir
-    print(f"Listing files from XRDFS directory: {xrdfs_path} ...")
+    # 0. Check the tools we depend on before touching the filesystem
+    if shutil.which("condor_submit") is None:
+        sys.exit("condor_submit not found in PATH")
+    if client is None and shutil.which("xrdfs") is None:
+        sys.exit("Neither the XRootD Python bindings nor xrdfs are available")
+    if not os.access(args.exec, os.X_OK):
+        sys.exit(f"{args.exec} is not executable")
+    if args.probe_files > 0 and any(shutil.which(tool) is None for tool in ("condor_wait", "condor_history", "condor_q")):
+        sys.exit("condor_wait, condor_history and condor_q are required for --probe-files")
+    if args.probe_files > 0 and args.dag:
+        sys.exit("--probe-files submits probe jobs directly and cannot be combined with --dag")
+    if not 0 < args.target_efficiency < 1:
+        sys.exit("--target-efficiency must be between 0 and 1")
+    if args.njobs < 1:
+        sys.exit("--njobs must be at least 1")
+    if args.dag and os.path.exists(args.dag):
+        with open(args.dag) as fdag:
+            if any(line.split()[:2] == ["JOB", args.tag] for line in fdag):
+                sys.exit(f"{args.dag} already has a node named {args.tag}")
 
-    try:
-        result = subprocess.run(
-            ["xrdfs", "dtn-eic.jlab.org", "ls", xrdfs_path],
-            check=True, stdout=subprocess.PIPE, text=True
-        )
-        files = [f"root://dtn-eic.jlab.org/{line.strip()}" for line in result.stdout.splitlines() if line.strip()]
+    # 1. List files from XRDFS (one recursive listing per directory, issued concurrently)
+    xrdfs_dirs = args.input_dir
+    print(f"Listing files from XRDFS directories: {' '.join(xrdfs_dirs)} ...")
 
-        if not files:
-            print(f"No files found in {xrdfs_path}")
-            return
+    try:
+        with ThreadPoolExecutor(max_workers=min(16, len(xrdfs_dirs))) as ex:
+            listings = list(ex.map(cached_list_xrdfs_dir if args.use_cache else list_xrdfs_dir, xrdfs_dirs))
 
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         print(f"Error listing XRDFS files: {e}")
         return
 
-    total_files = len(files)
-    n_requested = min(args.njobs, total_files)
-    print(f"Found {total_files} files, splitting into {n_requested} jobs...")
+    msgs = [f"  {xrdfs_path}: {len(listing)} files" for xrdfs_path, listing in zip(xrdfs_dirs, listings)]
+    print("\n".join(msgs))
+
+    files = [f"root://{XRDFS_SERVER}/{path}" for listing in listings for path in listing]
+
+    # Overlapping --input-dir arguments list the same file more than once
+    before = len(files)
+    files = list(dict.fromkeys(files))
+    dropped = before - len(files)
+    if dropped:
+        print(f"Dropped {dropped} duplicate entries")
+
+    if not files:
+        print(f"No files found in {' '.join(xrdfs_dirs)}")
+        return
 
     # 2. Prepare output directories
-    os.makedirs(args.output_dir, exist_ok=True)
-    job_folder = os.path.join(args.output_dir, f"job_{args.tag}")
-    os.makedirs(job_folder, exist_ok=True)
+    # Job scaffolding (lists, logs) lives on node-local scratch; only the submit
+    # file and the transferred output ROOT files land on the shared output dir
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    # mkdtemp gives every submission its own 0700 folder, so users sharing a
+    # staging dir (e.g. /tmp) can neither collide nor tamper with the job lists
+    staging_dir = os.path.abspath(args.staging_dir)
+    os.makedirs(staging_dir, exist_ok=True)
+    job_folder = tempfile.mkdtemp(prefix=f"job_{args.tag}_", dir=staging_dir)
+    print(f"Staging job files in {job_folder}")
 
-    # Save the XRDFS file list to disk for Condor jobs
-    input_list_file = os.path.join(job_folder, f"{args.tag}.list")
-    with open(input_list_file, "w") as f:
-        f.write("\n".join(files))
+    # Once the probe cluster is queued it owns its files and needs the job folder
+    probe_submitted = False
 
-    # 3. Partition files and prepare the item list for Condor
-    master_condor_file = os.path.join(job_folder, f"submit_{args.tag}.sub")
-    condor_items_file = os.path.join(job_folder, f"{args.tag}.items")
-    job_rows = []
+    try:
+        n_requested = args.njobs
 
-    for i in range(n_requested):
-        filenumber = i + 1
-        start = i * total_files // n_requested
-        end = (i + 1) * total_files // n_requested
-        files_for_job = files[start:end]
+        # Optionally size the jobs from probe runs; probe outputs are kept as
+        # regular results, so the probed files are removed from the main split
+        if args.probe_files > 0:
+            probe_files = files[:args.probe_files]
+            files = files[args.probe_files:]
+            avg_runtime = None
+            try:
+                cluster = submit_probe(args, probe_files, output_dir, job_folder)
+            except subprocess.CalledProcessError as e:
+                # Nothing was queued, so the probed files go back into the main split
+                print(f"Error submitting probe jobs: {e}")
+                files = probe_files + files
+            else:
+                probe_submitted = True
+                try:
+                    if cluster is not None:
+                        avg_runtime = probe_runtime(args, cluster, len(probe_files), job_folder)
+                except subprocess.CalledProcessError as e:
+                    # The probe jobs stay queued and still process their files, so
+                    # those files must not be submitted a second time
+                    print(f"Error waiting for probe jobs: {e}")
+                    print(f"Probe cluster {cluster} keeps its {len(probe_files)} files; they are not resubmitted")
 
-        # Create per-job input list
-        job_input_txt = os.path.join(job_folder, f"{args.tag}_{filenumber}_input.txt")
-        with open(job_input_txt, "w") as ftxt:
-            ftxt.write("\n".join(files_for_job))
+            if not files:
+                print("All files were processed by the probe jobs.")
+                return
+            if avg_runtime:
+                per_job = math.ceil(args.dispatch_wait * args.target_efficiency
+                                    / ((1 - args.target_efficiency) * avg_runtime))
+                n_requested = math.ceil(len(files) / per_job)
+                print(f"Probe jobs took {avg_runtime:.1f} s on average, using {per_job} files per job")
+            else:
+                print(f"No probe runtime available, keeping --njobs {args.njobs}")
 
-        # Output ROOT file path
-        output_root = os.path.join(job_folder, f"{args.tag}_{filenumber}.root")
-        job_tag = f"{args.tag}_{filenumber}"
+        total_files = len(files)
+        n_requested = min(n_requested, total_files)
+        print(f"Found {total_files} files, splitting into {n_requested} jobs...")
 
-        # Add row to items file
-        job_rows.append(f"{job_input_txt}, {output_root}, {job_tag}")
+        submit_body = write_job_files(args, args.tag, files, n_requested, output_dir, job_folder)
+    except BaseException:
+        if not probe_submitted:
+            shutil.rmtree(job_folder, ignore_errors=True)
+        raise
 
-    with open(condor_items_file, "w") as fitem:
-        fitem.write("\n".join(job_rows))
+    # 5a. DAG mode: embed the submit description as a node of a shared DAG so
+    # several tags go to the schedd in a single condor_submit_dag
+    if args.dag:
+        with open(args.dag, "a") as fdag:
+            fdag.write(f"SUBMIT-DESCRIPTION {args.tag}_desc {{\n{submit_body}}}\n")
+            fdag.write(f"JOB {args.tag} {args.tag}_desc\n\n")
+        print(f"Added {args.tag} to {args.dag}; submit with: condor_submit_dag {args.dag}")
+        return
 
-    # 4. Write Condor submit file
-    extra = f" {args.job_args}" if args.job_args else ""
-    with open(master_condor_file, "w") as f:
-        f.write("# HTCondor Submit File - V24 Compatible\n")
-        f.write("Universe       = vanilla\n")
-        f.write(f"Executable     = {args.exec}\n")
-        f.write("getenv         = true\n")
-        f.write("request_memory = 4G\n")
-        f.write("notification   = Never\n\n")
-        f.write(f"Arguments      = $(InFile) $(OutFile){extra}\n")
-        f.write(f"Output         = {job_folder}/$(Tag).out\n")
-        f.write(f"Error          = {job_folder}/$(Tag).err\n")
-        f.write(f"Log            = {job_folder}/$(Tag).log\n\n")
-        f.write(f"queue InFile, OutFile, Tag from {condor_items_file}\n")
-
-    # 5. Submit to Condor
-    print(f"Submitting to Condor using {master_condor_file} ...")
+    # 5. Submit to Condor, feeding the submit description on stdin
+    print(f"Submitting {args.tag} to Condor ...")
     try:
-        subprocess.run(["condor_submit", master_condor_file], check=True)
+        subprocess.run(["condor_submit"], input=submit_body, text=True, check=True)
         print("Submission successful.")
     except subprocess.CalledProcessError as e:
         print(f"Error during submission: {e}")